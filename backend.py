@@ -1,13 +1,25 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from rag_supabase import SupabaseRAG
 from pydantic import BaseModel
+from sse_starlette.sse import EventSourceResponse
+from contextlib import asynccontextmanager
+import aiofiles
 import os
-import shutil
 
-app = FastAPI(title="RAG Microservice")
+# Created per worker process at startup rather than at import time
+rag: SupabaseRAG = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global rag
+    rag = SupabaseRAG()
+    yield
+    await rag.aclose()
+
+app = FastAPI(title="RAG Microservice", lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -18,19 +30,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize RAG
-rag = SupabaseRAG()
-
 # Create uploads directory
 os.makedirs("uploads", exist_ok=True)
 os.makedirs("static", exist_ok=True)
 
+# Serve the frontend through StaticFiles; its same-origin requests carry no Origin
+# header, so CORSMiddleware passes them straight through
+app.mount("/static", StaticFiles(directory="static"), name="static")
+
 class QueryRequest(BaseModel):
     question: str
 
 @app.get("/")
 async def root():
-    return FileResponse("static/page1.html")
+    return RedirectResponse("/static/page1.html")
 
 @app.post("/upload")
 async def upload_document(file: UploadFile = File(...)):
@@ -38,11 +51,13 @@ async def upload_document(file: UploadFile = File(...)):
     try:
         # Save uploaded file
         file_path = f"uploads/{file.filename}"
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        async with aiofiles.open(file_path, "wb") as buffer:
+            # Write in 1MB chunks so the event loop is released between reads
+            while chunk := await file.read(1 << 20):
+                await buffer.write(chunk)
         
         # Process and store in database
-        num_chunks = rag.load_and_process_document(file_path)
+        num_chunks = await rag.load_and_process_document(file_path)
         
         return {
             "success": True,
@@ -51,19 +66,15 @@ async def upload_document(file: UploadFile = File(...)):
         }
     
     except ValueError as e:
-        raise HTTPException(status_code=400, detail=f"Invalid file type: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to upload document: {e}")
 
 @app.post("/query")
 async def query_documents(request: QueryRequest):
     """Query documents with streaming response"""
-    async def generate():
-        async for chunk in rag.query_stream(request.question):
-            # Server-Sent Events format
-            yield f"data: {chunk}\n\n"
-    
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    # EventSourceResponse handles Server-Sent Events framing and keep-alive pings
+    return EventSourceResponse(rag.query_stream(request.question), sep="\n")
 
 @app.delete("/clear")
 async def clear_database():
@@ -80,4 +91,14 @@ async def health():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count()))
+    # Workers inherit the environment, so each one can size its own resources from this
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    uvicorn.run(
+        "backend:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="uvloop",
+        http="httptools"
+    )
@@ -1,11 +1,13 @@
 from langchain_community.document_loaders import PyPDFLoader, TextLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_text_splitters import TokenTextSplitter
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
 import os
+import faiss
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -31,13 +33,13 @@ class RAGPipeline:
         print(f"✅ Loaded {len(documents)} document(s)")
         return documents
     
-    def split_documents(self, documents, chunk_size=1000, chunk_overlap=200):
-        print(f"✂️  Splitting documents (chunk_size={chunk_size}, overlap={chunk_overlap})")
+    def split_documents(self, documents, chunk_size=400, chunk_overlap=40):
+        print(f"✂️  Splitting documents (chunk_size={chunk_size} tokens, overlap={chunk_overlap})")
         
-        text_splitter = RecursiveCharacterTextSplitter(
+        text_splitter = TokenTextSplitter(
+            encoding_name="cl100k_base",
             chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            separators=["\n\n", "\n", " ", ""]
+            chunk_overlap=chunk_overlap
         )
         
         chunks = text_splitter.split_documents(documents)
@@ -48,13 +50,25 @@ class RAGPipeline:
         print("🧮 Creating embeddings and building vector store...")
         
         self.embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
-        self.vector_store = FAISS.from_documents(chunks, self.embeddings)
+        
+        # HNSW graph index instead of the brute-force IndexFlatL2 used by from_documents
+        index = faiss.IndexHNSWFlat(1536, 32)
+        index.hnsw.efConstruction = 200
+        self.vector_store = FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=InMemoryDocstore({}),
+            index_to_docstore_id={}
+        )
+        self.vector_store.add_documents(chunks)
         
         print("✅ Vector store created successfully")
         return self.vector_store
     
     def setup_retriever(self, k=4):
         print(f"🔍 Setting up retriever (k={k})")
+        if isinstance(self.vector_store.index, faiss.IndexHNSW):
+            self.vector_store.index.hnsw.efSearch = 64
         self.retriever = self.vector_store.as_retriever(search_kwargs={'k': k})
         print("✅ Retriever ready")
         return self.retriever
@@ -122,7 +136,7 @@ if __name__ == "__main__":
     rag = RAGPipeline()
     
     documents = rag.load_documents("test_document.txt")
-    chunks = rag.split_documents(documents, chunk_size=500, chunk_overlap=50)
+    chunks = rag.split_documents(documents, chunk_size=125, chunk_overlap=15)
     rag.create_vector_store(chunks)
     rag.setup_retriever(k=3)
     rag.create_rag_chain()
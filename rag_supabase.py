@@ -1,16 +1,120 @@
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_community.document_loaders import PyPDFLoader, TextLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_community.document_loaders import TextLoader
+from langchain_text_splitters import TokenTextSplitter
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from supabase import create_client, Client
+from langchain_core.documents import Document
+from supabase import create_client, Client, ClientOptions
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_TIMEOUT
+from concurrent.futures import ProcessPoolExecutor
 import os
 from dotenv import load_dotenv
-from typing import List, Dict
-import json
+from typing import List, Dict, Tuple, Optional
+from collections import OrderedDict
+import numpy as np
+import faiss
+import pymupdf
+import httpx
+import asyncio
+import multiprocessing
+import io
+import time
+import uuid
 
 load_dotenv()
 
+# Number of texts sent per concurrent embedding request
+EMBED_BATCH_SIZE = 256
+# Number of rows sent per concurrent insert_documents_bulk RPC call
+INSERT_BATCH_SIZE = 100
+# Dimension of text-embedding-3-small vectors
+EMBEDDING_DIM = 1536
+# Number of query embeddings kept in the in-process LRU cache
+QUERY_CACHE_SIZE = 1024
+# Number of recent answers kept for semantic short-circuiting, and the cosine needed to reuse one
+ANSWER_CACHE_SIZE = 256
+ANSWER_CACHE_THRESHOLD = 0.95
+# Seconds a cached answer stays valid
+ANSWER_CACHE_TTL = 300
+# Number of server worker processes on this machine (uvicorn's WEB_CONCURRENCY)
+SERVER_WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+# Uploads and clears only invalidate the answer cache of the worker that handled them,
+# so with several workers the cache is off unless ANSWER_CACHE=1 is set explicitly
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE", "1" if SERVER_WORKERS == 1 else "0") == "1"
+# Shared keep-alive connection pool limits for the OpenAI and Supabase HTTP clients
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+# PDFs with more pages than this are split across several pool tasks, this many pages per task
+PDF_PARALLEL_PAGE_THRESHOLD = 50
+PDF_PAGES_PER_WORKER = 5
+
+PROMPT_TEMPLATE = """You are a helpful AI assistant. Use the following context to answer the question.
+If you don't know the answer, say so. Be concise and accurate.
+
+Context:
+{context}
+
+Question: {question}
+
+Answer:"""
+
+NO_CONTEXT_ANSWER = "I don't have enough information to answer that question. Please make sure documents are uploaded and the database is set up correctly."
+
+# PyMuPDF is not thread-safe, so every PDF call runs in this pool's worker processes.
+# Created on first use so text-only deployments never spawn workers
+_process_pool = None
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        # Share the cores with the other server workers instead of each spawning cpu_count processes
+        # Never fork: by the time the pool starts, this process runs executor threads and HTTP pools.
+        # forkserver is unavailable on Windows, where spawn is already the default
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _process_pool = ProcessPoolExecutor(
+            max_workers=max(1, (os.cpu_count() or 1) // SERVER_WORKERS),
+            mp_context=multiprocessing.get_context(start_method)
+        )
+    return _process_pool
+
+
+def _split_documents(documents: List[Document]) -> List[Document]:
+    """Split loaded pages into chunks of embedding-model tokens"""
+    text_splitter = TokenTextSplitter(
+        encoding_name="cl100k_base",
+        chunk_size=400,
+        chunk_overlap=40
+    )
+    return text_splitter.split_documents(documents)
+
+
+def _inspect_pdf(file_path: str) -> Tuple[bool, int]:
+    """Return whether a PDF needs a password, and its page count"""
+    with pymupdf.open(file_path) as pdf:
+        return pdf.needs_pass, pdf.page_count
+
+
+def _load_pdf_fast(file_path: str, start: int = 0, end: Optional[int] = None) -> List[Document]:
+    """Extract the text of pages [start, end) with PyMuPDF's C parser"""
+    with pymupdf.open(file_path) as pdf:
+        return [
+            Document(
+                page_content=pdf[page].get_text(),
+                metadata={"source": file_path, "page": page}
+            )
+            for page in range(start, pdf.page_count if end is None else end)
+        ]
+
+
+def _parse_pdf_range(file_path: str, start: int, end: int) -> List[Document]:
+    """Load and split pages [start, end) of a PDF; runs inside a worker process"""
+    return _split_documents(_load_pdf_fast(file_path, start, end))
+
+
+def _load_and_split(loader) -> List[Document]:
+    return _split_documents(loader.load())
+
+
 class SupabaseRAG:
     def __init__(self):
         print("🚀 Initializing SupabaseRAG...")
@@ -30,12 +134,29 @@ class SupabaseRAG:
         print(f"📡 Connecting to Supabase: {self.supabase_url}")
         
         # --- Client Initialization ---
-        self.supabase: Client = create_client(self.supabase_url, self.supabase_key)
+        # Long-lived HTTP/2 clients so every request reuses warm TLS connections
+        self._http = httpx.AsyncClient(http2=True, limits=HTTP_LIMITS)
+        # postgrest uses an injected client as-is, so carry over the timeout and redirect
+        # handling its own client would have (httpx alone defaults to a 5s timeout)
+        self._supabase_http = httpx.Client(
+            http2=True,
+            limits=HTTP_LIMITS,
+            timeout=httpx.Timeout(DEFAULT_POSTGREST_CLIENT_TIMEOUT),
+            follow_redirects=True
+        )
+        
+        self.supabase: Client = create_client(
+            self.supabase_url,
+            self.supabase_key,
+            options=ClientOptions(httpx_client=self._supabase_http)
+        )
         
         # Initialize embeddings
         self.embeddings = OpenAIEmbeddings(
             openai_api_key=self.openai_api_key,
-            model="text-embedding-3-small"
+            model="text-embedding-3-small",
+            chunk_size=512,
+            http_async_client=self._http
         )
         
         # Initialize LLM with streaming
@@ -43,95 +164,211 @@ class SupabaseRAG:
             openai_api_key=self.openai_api_key,
             model="gpt-3.5-turbo",
             temperature=0,
-            streaming=True
+            streaming=True,
+            http_async_client=self._http
         )
         
+        # Compile the prompt and chain once rather than on every query
+        self._prompt = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
+        self._chain = self._prompt | self.llm | StrOutputParser()
+        
+        # --- Query Caches ---
+        # Normalized question -> embedding, in LRU order
+        self._query_embedding_cache: "OrderedDict[str, Tuple[float, ...]]" = OrderedDict()
+        # Recent (embedding, answer) pairs; row i of the index belongs to self._cached_answers[i],
+        # stored as (time cached, streamed chunks)
+        self._answer_index = faiss.IndexFlatIP(EMBEDDING_DIM)
+        self._cached_answers: List[Tuple[float, List[str]]] = []
+        # Bumped on every clear so answers streamed across an upload or clear are not cached
+        self._answer_cache_generation = 0
+        
         print("✅ SupabaseRAG initialized")
         
-    def load_and_process_document(self, file_path: str):
+    async def load_and_process_document(self, file_path: str):
         """Load document, chunk it, and store in Supabase"""
         print(f"📄 Processing: {file_path}")
         
-        # Load document
+        # Load and split off the event loop: PDFs in worker processes, text files in a thread
+        loop = asyncio.get_running_loop()
         if file_path.endswith('.pdf'):
-            loader = PyPDFLoader(file_path)
+            pool = _get_process_pool()
+            needs_password, num_pages = await loop.run_in_executor(pool, _inspect_pdf, file_path)
+            if needs_password:
+                # Files that only carry an owner password open normally; a user password cannot be supplied
+                raise ValueError("Password-protected PDFs are not supported")
+            print(f"✅ Found {num_pages} pages")
+            if num_pages > PDF_PARALLEL_PAGE_THRESHOLD:
+                parts = await asyncio.gather(*(
+                    loop.run_in_executor(
+                        pool, _parse_pdf_range, file_path, start, min(start + PDF_PAGES_PER_WORKER, num_pages)
+                    )
+                    for start in range(0, num_pages, PDF_PAGES_PER_WORKER)
+                ))
+                chunks = [chunk for part in parts for chunk in part]
+            else:
+                chunks = await loop.run_in_executor(pool, _parse_pdf_range, file_path, 0, num_pages)
         elif file_path.endswith('.txt'):
-            loader = TextLoader(file_path, encoding='utf-8')
+            chunks = await loop.run_in_executor(None, _load_and_split, TextLoader(file_path, encoding='utf-8'))
         else:
-            raise ValueError("Unsupported file type")
-        
-        documents = loader.load()
-        print(f"✅ Loaded {len(documents)} pages")
+            raise ValueError("Unsupported file type. Use .pdf or .txt")
         
-        # Split into chunks
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            separators=["\n\n", "\n", " ", ""]
-        )
-        chunks = text_splitter.split_documents(documents)
         print(f"✂️  Created {len(chunks)} chunks")
         
         # Store in Supabase
-        self._store_chunks(chunks, file_path)
+        await self._store_chunks(chunks, file_path)
         print(f"💾 Stored in Supabase database")
         
+        # Cached answers may no longer reflect the database contents
+        self._clear_answer_cache()
+        
         return len(chunks)
     
-    def _store_chunks(self, chunks, source_file):
+    async def _store_chunks(self, chunks, source_file):
         """Store document chunks with embeddings in Supabase using batch insertion"""
         print(f"🔄 Preparing {len(chunks)} chunks for batch insertion...")
         
+        # Embed each distinct text once; repeated boilerplate chunks share a vector
+        text_positions = {}
+        texts = []
+        positions = []
+        for chunk in chunks:
+            if chunk.page_content not in text_positions:
+                text_positions[chunk.page_content] = len(texts)
+                texts.append(chunk.page_content)
+            positions.append(text_positions[chunk.page_content])
+        
+        # Generate embeddings in batches, issuing the batch requests concurrently
+        starts = range(0, len(texts), EMBED_BATCH_SIZE)
+        results = await asyncio.gather(*(
+            self.embeddings.aembed_documents(texts[start:start + EMBED_BATCH_SIZE]) for start in starts
+        ))
+        
+        # float16 matrix matching the halfvec column, filled batch by batch
+        vectors = np.empty((len(texts), EMBEDDING_DIM), dtype=np.float16)
+        for start, group in zip(starts, results):
+            vectors[start:start + len(group)] = group
+        
+        # Format each row as a halfvec text literal for pgvector's parser; 5 significant
+        # digits round-trip float16 exactly and savetxt formats a whole row per call
+        buffer = io.StringIO()
+        np.savetxt(buffer, vectors, fmt='%.5g', delimiter=',')
+        encoded = [f"[{line}]" for line in buffer.getvalue().splitlines()]
+        print(f"✅ Generated {len(vectors)} embeddings for {len(chunks)} chunks")
+        
+        # Tags every row of this upload so a failed insert can be rolled back
+        upload_id = uuid.uuid4().hex
+        
         insert_data = []
-        for i, chunk in enumerate(chunks):
-            # Generate embedding
-            embedding = self.embeddings.embed_query(chunk.page_content)
-            
+        for i, (chunk, position) in enumerate(zip(chunks, positions)):
             # Prepare metadata
             metadata = {
                 "source": source_file,
                 "chunk_index": i,
-                "page": chunk.metadata.get("page", 0)
+                "page": chunk.metadata.get("page", 0),
+                "upload_id": upload_id
             }
             
             insert_data.append({
                 "content": chunk.page_content,
-                "metadata": json.dumps(metadata),
-                "embedding": embedding
+                "metadata": metadata,
+                "embedding": encoded[position]
             })
         
-        # Perform batch insert
-        try:
-            result = self.supabase.table('documents').insert(insert_data).execute()
-            print(f"✅ Successfully batch inserted {len(insert_data)} chunks into database.")
-        except Exception as e:
-            print(f"❌ Error during batch insertion: {e}")
-            raise
+        # Perform batch insert in fixed-size slices so no single request carries the whole document.
+        # Each slice commits on its own, so wait for all of them and undo the whole upload if any failed
+        batches = [insert_data[i:i + INSERT_BATCH_SIZE] for i in range(0, len(insert_data), INSERT_BATCH_SIZE)]
+        results = await asyncio.gather(*(
+            asyncio.to_thread(self.supabase.rpc('insert_documents_bulk', {'payload': batch}).execute)
+            for batch in batches
+        ), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            print(f"❌ Error during batch insertion: {errors[0]}")
+            try:
+                await asyncio.to_thread(
+                    self.supabase.table('documents').delete().eq('metadata->>upload_id', upload_id).execute
+                )
+                print(f"↩️  Removed partially inserted chunks of {source_file}")
+            except Exception as e:
+                print(f"❌ Error removing partially inserted chunks (upload_id={upload_id}): {e}")
+            raise errors[0]
+        print(f"✅ Successfully batch inserted {len(insert_data)} chunks into database ({len(batches)} requests).")
+    
+    async def _embed_question(self, question: str) -> Tuple[float, ...]:
+        """Embed a question, reusing cached embeddings for repeated questions"""
+        key = question.strip().lower()
+        
+        cached = self._query_embedding_cache.get(key)
+        if cached is not None:
+            self._query_embedding_cache.move_to_end(key)
+            print("⚡ Reusing cached query embedding")
+            return cached
+        
+        embedding = tuple(await self.embeddings.aembed_query(question))
+        self._query_embedding_cache[key] = embedding
+        if len(self._query_embedding_cache) > QUERY_CACHE_SIZE:
+            self._query_embedding_cache.popitem(last=False)
+        return embedding
     
-    def retrieve_relevant_chunks(self, question: str, k: int = 4) -> List[Dict]:
-        """Retrieve relevant chunks using properly formatted vector"""
+    def _lookup_cached_answer(self, query_embedding: Tuple[float, ...]):
+        """Return a recent answer to a near-identical question, if any"""
+        if not ANSWER_CACHE_ENABLED or not self._cached_answers:
+            return None
+        
+        vector = np.asarray([query_embedding], dtype=np.float32)
+        faiss.normalize_L2(vector)
+        scores, ids = self._answer_index.search(vector, 1)
+        if scores[0][0] > ANSWER_CACHE_THRESHOLD:
+            cached_at, answer = self._cached_answers[ids[0][0]]
+            if time.monotonic() - cached_at <= ANSWER_CACHE_TTL:
+                print(f"⚡ Reusing cached answer (similarity: {scores[0][0]:.4f})")
+                return answer
+        return None
+    
+    def _store_cached_answer(self, query_embedding: Tuple[float, ...], answer: List[str]):
+        """Remember the streamed chunks of an answer, evicting the oldest one when the cache is full"""
+        if not ANSWER_CACHE_ENABLED:
+            return
+        
+        if len(self._cached_answers) >= ANSWER_CACHE_SIZE:
+            # IndexFlat compacts ids on removal, keeping rows aligned with the list
+            self._answer_index.remove_ids(np.array([0], dtype=np.int64))
+            self._cached_answers.pop(0)
+        
+        vector = np.asarray([query_embedding], dtype=np.float32)
+        faiss.normalize_L2(vector)
+        self._answer_index.add(vector)
+        self._cached_answers.append((time.monotonic(), answer))
+    
+    def _clear_answer_cache(self):
+        """Drop all cached answers"""
+        self._answer_cache_generation += 1
+        self._answer_index.reset()
+        self._cached_answers.clear()
+    
+    async def retrieve_relevant_chunks(
+        self, question: str, k: int = 4, query_embedding: Optional[Tuple[float, ...]] = None
+    ) -> List[Dict]:
+        """Retrieve relevant chunks using properly formatted vector; reuses query_embedding when given"""
         print(f"\n🔍 Searching for: '{question}'")
         
         try:
             # Generate embedding
-            query_embedding = self.embeddings.embed_query(question)
-            print(f"✅ Generated query embedding (dimension: {len(query_embedding)})")
-            
-            # Check total documents
-            count_result = self.supabase.table('documents').select('id', count='exact').execute()
-            print(f"📊 Total documents in database: {count_result.count if hasattr(count_result, 'count') else len(count_result.data)}")
+            if query_embedding is None:
+                query_embedding = await self._embed_question(question)
+                print(f"✅ Generated query embedding (dimension: {len(query_embedding)})")
             
             print(f"🔎 Calling match_documents RPC...")
             
             # Call RPC with properly formatted vector string
-            result = self.supabase.rpc(
+            result = await asyncio.to_thread(self.supabase.rpc(
                 'match_documents',
                 {
-                    'query_embedding': query_embedding,
+                    'query_embedding': list(query_embedding),
                     'match_threshold': 0.0,
                     'match_count': k
                 }
-            ).execute()
+            ).execute)
             
             if result.data:
                 print(f"✅ Found {len(result.data)} relevant chunks")
@@ -151,50 +388,64 @@ class SupabaseRAG:
     async def query_stream(self, question: str):
         """Stream answer token by token"""
         print(f"\n❓ Question: {question}")
+        cache_generation = self._answer_cache_generation
+        
+        # Short-circuit near-duplicate questions with a recent answer
+        try:
+            query_embedding = await self._embed_question(question)
+        except Exception as e:
+            print(f"❌ Error embedding question: {e}")
+            yield NO_CONTEXT_ANSWER
+            return
+        
+        cached_answer = self._lookup_cached_answer(query_embedding)
+        if cached_answer is not None:
+            for chunk in cached_answer:
+                yield chunk
+            return
         
         # Retrieve relevant chunks
-        relevant_docs = self.retrieve_relevant_chunks(question, k=3)
+        relevant_docs = await self.retrieve_relevant_chunks(question, k=3, query_embedding=query_embedding)
         
         if not relevant_docs:
             print("⚠️  No relevant documents found")
-            yield "I don't have enough information to answer that question. Please make sure documents are uploaded and the database is set up correctly."
+            yield NO_CONTEXT_ANSWER
             return
         
         # Format context
-        context = "\n\n".join([doc['content'] for doc in relevant_docs])
+        context = "\n\n".join(doc['content'] for doc in relevant_docs)
         print(f"📝 Context length: {len(context)} characters")
         
-        # Create prompt
-        template = """You are a helpful AI assistant. Use the following context to answer the question.
-If you don't know the answer, say so. Be concise and accurate.
-
-Context:
-{context}
-
-Question: {question}
-
-Answer:"""
-        
-        prompt = ChatPromptTemplate.from_template(template)
-        
         # Stream response
-        chain = prompt | self.llm | StrOutputParser()
-        
         print("🤖 Starting to stream response...")
-        async for chunk in chain.astream({"context": context, "question": question}):
+        answer_parts = []
+        async for chunk in self._chain.astream({"context": context, "question": question}):
+            answer_parts.append(chunk)
             yield chunk
         
         # Yield sources at the end
-        yield "\n\n📚 **Sources:**\n"
+        answer_parts.append("\n\n📚 **Sources:**\n")
+        yield answer_parts[-1]
         for i, doc in enumerate(relevant_docs, 1):
-            metadata = json.loads(doc['metadata'])
+            metadata = doc['metadata']
             similarity = doc.get('similarity', 0)
-            yield f"\n{i}. {metadata['source']} (page {metadata.get('page', 'N/A')}, similarity: {similarity:.2f})"
+            answer_parts.append(f"\n{i}. {metadata['source']} (page {metadata.get('page', 'N/A')}, similarity: {similarity:.2f})")
+            yield answer_parts[-1]
+        
+        # The documents may have changed while this answer streamed
+        if cache_generation == self._answer_cache_generation:
+            self._store_cached_answer(query_embedding, answer_parts)
+    
+    async def aclose(self):
+        """Close the shared HTTP connection pools"""
+        await self._http.aclose()
+        self._supabase_http.close()
     
     def clear_database(self):
         """Clear all documents from database"""
         try:
             result = self.supabase.table('documents').delete().neq('id', 0).execute()
+            self._clear_answer_cache()
             print("🗑️  Database cleared")
             return True
         except Exception as e: